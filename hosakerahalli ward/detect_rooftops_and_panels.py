@@ -1,10 +1,12 @@
 import os
 import json
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 import cv2
 import numpy as np
-from shapely.geometry import Polygon, mapping, box
+import shapely
+from shapely.geometry import MultiPolygon, Polygon, mapping, box
 from shapely.ops import unary_union
-from ultralytics import YOLO
 
 # CONFIG
 IMAGE_DIR = "images"
@@ -13,6 +15,13 @@ PANEL_MODEL_PATH = "model/detect/train/weights/best.pt"
 OUTPUT_GEOJSON = "rooftops.geojson"
 METERS_PER_PIXEL = 0.145
 DEG_PER_METER = 1 / 111320
+COVERAGE_BLOCK_DEG = 0.005  # ~550m tile blocks for the first union pass
+COVERAGE_WORKERS = os.cpu_count() or 1
+# Placeholders: only timed on one core so far, where the pool never paid for itself
+COVERAGE_PARALLEL_MIN_BLOCKS = 16
+COVERAGE_PARALLEL_MIN_ROOFS = 10000
+COVERAGE_DENSE_FILL = 1.0  # roof area / roof bounding box area above which a plain union is faster
+COVERAGE_STATS = False
 
 def mask_to_polygons(mask):
     mask = (mask * 255).astype(np.uint8)
@@ -38,107 +47,167 @@ def parse_coords_from_name(fname):
     parts = fname.replace(".png", "").split("_")
     return float(parts[-2]), float(parts[-1])
 
-# Load models
-roof_model = YOLO(ROOF_MODEL_PATH)
-panel_model = YOLO(PANEL_MODEL_PATH)
-geojson = {"type": "FeatureCollection", "features": []}
-
-for fname in os.listdir(IMAGE_DIR):
-    if not fname.endswith(".png"):
-        continue
-
-    img_path = os.path.join(IMAGE_DIR, fname)
-    print(f"📍 Processing {fname}")
-    lat_center, lon_center = parse_coords_from_name(fname)
-
-    img = cv2.imread(img_path)
-    if img is None:
-        print(f"⚠️ Could not read image: {fname}")
-        continue
-    h, w = img.shape[:2]
-
-    # Rooftop segmentation
-    roof_results = roof_model(img_path, conf=0.3)[0]
-    if roof_results.masks is None:
-        continue
-    masks = roof_results.masks.data.cpu().numpy()
-    roof_polygons = []
-    for mask in masks:
-        roof_polygons.extend(mask_to_polygons(mask))
-
-    # Solar panel object detection
-    panel_results = panel_model(img_path, conf=0.3)[0]
-    panel_boxes = []
-    if panel_results.boxes is not None:
-        xyxy = panel_results.boxes.xyxy.cpu().numpy()
-        for x1, y1, x2, y2 in xyxy:
-            panel_boxes.append(box(x1, y1, x2, y2))  # Shapely box
-
-    # Convert solar boxes to geographic coordinates
-    geo_solar_panels = []
-    for b in panel_boxes:
-        pixel_coords = list(b.exterior.coords)
-        geo_coords = [pixel_to_latlon(x, y, lat_center, lon_center, w, h) for x, y in pixel_coords]
-        geo_solar_panels.append(Polygon([(lon, lat) for lat, lon in geo_coords]))
-
-    # For each rooftop polygon
-    for roof_poly in roof_polygons:
-        pixel_coords = np.array(roof_poly.exterior.coords)
-        geo_coords = [pixel_to_latlon(x, y, lat_center, lon_center, w, h) for x, y in pixel_coords]
-        geo_poly = Polygon([(lon, lat) for lat, lon in geo_coords])
-        if not geo_poly.is_valid:
+def bucket_by_block(polygons, block_deg=COVERAGE_BLOCK_DEG):
+    # Group roofs into tile blocks keyed by the (row, col) of their lower-left corner
+    blocks = {}
+    for poly in polygons:
+        minx, miny, _, _ = poly.bounds
+        key = (int(miny // block_deg), int(minx // block_deg))
+        blocks.setdefault(key, []).append(poly)
+    return blocks
+
+def hierarchical_union(blocks, pool=None):
+    # Union each block on its own, then re-union only the pieces that can touch another block
+    parts = [blocks[key] for key in sorted(blocks)]
+    roofs = [poly for part in parts for poly in part]
+    minx, miny, maxx, maxy = shapely.total_bounds(roofs)
+    # Densely packed roofs join up across block edges, so splitting only adds work
+    if len(parts) == 1 or shapely.area(roofs).sum() > COVERAGE_DENSE_FILL * (maxx - minx) * (maxy - miny):
+        return unary_union(roofs)
+
+    if (pool is not None and COVERAGE_WORKERS > 1 and len(parts) >= COVERAGE_PARALLEL_MIN_BLOCKS
+            and len(roofs) >= COVERAGE_PARALLEL_MIN_ROOFS):
+        unions = list(pool.map(unary_union, parts))
+    else:
+        unions = [unary_union(part) for part in parts]
+
+    # Every roof of a block lies inside that block's envelope, so a piece that
+    # misses all other envelopes is already final
+    envelopes = [box(*shapely.total_bounds(part)) for part in parts]
+    pieces = [shapely.get_parts(union) for union in unions]
+    owners = np.concatenate([np.full(len(p), i) for i, p in enumerate(pieces)])
+    pieces = np.concatenate(pieces)
+    src, hit = shapely.STRtree(envelopes).query(pieces, predicate="intersects")
+    border = np.zeros(len(pieces), dtype=bool)
+    border[src[owners[src] != hit]] = True
+
+    merged = list(shapely.get_parts(unary_union(pieces[border]))) if border.any() else []
+    result = list(pieces[~border]) + merged
+    return result[0] if len(result) == 1 else MultiPolygon(result)
+
+def coverage_stats(coverage):
+    # Exact covered area in m^2 and its share of the roofs' convex hull
+    m2_per_deg2 = np.cos(np.radians(coverage.centroid.y)) / DEG_PER_METER ** 2
+    hull_area = coverage.convex_hull.area
+    return {
+        "coverage_area_m2": round(float(coverage.area * m2_per_deg2), 2),
+        "coverage_density": round(coverage.area / hull_area, 4) if hull_area else 1.0,
+    }
+
+def main():
+    # Imported here so coverage worker processes do not load it on spawn
+    from ultralytics import YOLO
+
+    # Load models
+    roof_model = YOLO(ROOF_MODEL_PATH)
+    panel_model = YOLO(PANEL_MODEL_PATH)
+    geojson = {"type": "FeatureCollection", "features": []}
+    rooftop_polys = []
+    green = 0
+
+    for fname in os.listdir(IMAGE_DIR):
+        if not fname.endswith(".png"):
             continue
 
-        # Check intersection
-        has_solar = any(geo_poly.intersects(panel) for panel in geo_solar_panels)
+        img_path = os.path.join(IMAGE_DIR, fname)
+        print(f"📍 Processing {fname}")
+        lat_center, lon_center = parse_coords_from_name(fname)
 
-        # Add rooftop feature
-        geojson["features"].append({
-            "type": "Feature",
-            "geometry": mapping(geo_poly),
-            "properties": {
-                "image": fname,
-                "class": "rooftop",
-                "area_px": roof_poly.area,
-                "has_solar": has_solar
-            }
-        })
+        img = cv2.imread(img_path)
+        if img is None:
+            print(f"⚠️ Could not read image: {fname}")
+            continue
+        h, w = img.shape[:2]
 
-        # Add solar box overlays inside this roof
-        if has_solar:
-            for panel in geo_solar_panels:
-                if geo_poly.intersects(panel):
-                    geojson["features"].append({
-                        "type": "Feature",
-                        "geometry": mapping(panel),
-                        "properties": {
-                            "type": "solar_box",
-                            "belongs_to": fname
-                        }
-                    })
-
-# --- Coverage mask with stats ---
-all_roof_geos = [f for f in geojson["features"] if f["properties"].get("class") == "rooftop"]
-rooftop_polys = [Polygon(f["geometry"]["coordinates"][0]) for f in all_roof_geos]
-
-if rooftop_polys:
-    coverage_polygon = unary_union(rooftop_polys)
-    green = sum(1 for f in all_roof_geos if f["properties"]["has_solar"])
-    red = len(all_roof_geos) - green
-
-    geojson["features"].append({
-        "type": "Feature",
-        "geometry": mapping(coverage_polygon),
-        "properties": {
+        # Rooftop segmentation
+        roof_results = roof_model(img_path, conf=0.3)[0]
+        if roof_results.masks is None:
+            continue
+        masks = roof_results.masks.data.cpu().numpy()
+        roof_polygons = []
+        for mask in masks:
+            roof_polygons.extend(mask_to_polygons(mask))
+
+        # Solar panel object detection
+        panel_results = panel_model(img_path, conf=0.3)[0]
+        panel_boxes = []
+        if panel_results.boxes is not None:
+            xyxy = panel_results.boxes.xyxy.cpu().numpy()
+            for x1, y1, x2, y2 in xyxy:
+                panel_boxes.append(box(x1, y1, x2, y2))  # Shapely box
+
+        # Convert solar boxes to geographic coordinates
+        geo_solar_panels = []
+        for b in panel_boxes:
+            pixel_coords = list(b.exterior.coords)
+            geo_coords = [pixel_to_latlon(x, y, lat_center, lon_center, w, h) for x, y in pixel_coords]
+            geo_solar_panels.append(Polygon([(lon, lat) for lat, lon in geo_coords]))
+
+        # For each rooftop polygon
+        for roof_poly in roof_polygons:
+            pixel_coords = np.array(roof_poly.exterior.coords)
+            geo_coords = [pixel_to_latlon(x, y, lat_center, lon_center, w, h) for x, y in pixel_coords]
+            geo_poly = Polygon([(lon, lat) for lat, lon in geo_coords])
+            if not geo_poly.is_valid:
+                continue
+
+            # Check intersection
+            has_solar = any(geo_poly.intersects(panel) for panel in geo_solar_panels)
+
+            # Add rooftop feature
+            geojson["features"].append({
+                "type": "Feature",
+                "geometry": mapping(geo_poly),
+                "properties": {
+                    "image": fname,
+                    "class": "rooftop",
+                    "area_px": roof_poly.area,
+                    "has_solar": has_solar
+                }
+            })
+
+            # Add solar box overlays inside this roof
+            if has_solar:
+                for panel in geo_solar_panels:
+                    if geo_poly.intersects(panel):
+                        geojson["features"].append({
+                            "type": "Feature",
+                            "geometry": mapping(panel),
+                            "properties": {
+                                "type": "solar_box",
+                                "belongs_to": fname
+                            }
+                        })
+
+            rooftop_polys.append(geo_poly)
+            green += bool(has_solar)
+
+    # --- Coverage mask with stats ---
+    if rooftop_polys:
+        blocks = bucket_by_block(rooftop_polys)
+        # Spawned workers start clean instead of inheriting the loaded models
+        with ProcessPoolExecutor(max_workers=COVERAGE_WORKERS, mp_context=get_context("spawn")) as pool:
+            coverage_polygon = hierarchical_union(blocks, pool)
+        properties = {
             "type": "coverage_mask",
-            "total_rooftops": len(all_roof_geos),
+            "total_rooftops": len(rooftop_polys),
             "green_rooftops": green,
-            "red_rooftops": red
+            "red_rooftops": len(rooftop_polys) - green
         }
-    })
+        if COVERAGE_STATS:
+            properties.update(coverage_stats(coverage_polygon))
+
+        geojson["features"].append({
+            "type": "Feature",
+            "geometry": mapping(coverage_polygon),
+            "properties": properties
+        })
+
+    # Save GeoJSON
+    with open(OUTPUT_GEOJSON, "w") as f:
+        json.dump(geojson, f, indent=2)
 
-# Save GeoJSON
-with open(OUTPUT_GEOJSON, "w") as f:
-    json.dump(geojson, f, indent=2)
+    print(f"✅ Done. Saved {len(geojson['features'])} features to {OUTPUT_GEOJSON}")
 
-print(f"✅ Done. Saved {len(geojson['features'])} features to {OUTPUT_GEOJSON}")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import importlib.util
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+from shapely.geometry import box
+from shapely.ops import unary_union
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = [
+    os.path.join(ROOT, "five ward analysis", "roof_and_panel_detection_into_geojson.py"),
+    os.path.join(ROOT, "hosakerahalli ward", "detect_rooftops_and_panels.py"),
+]
+
+
+def load_script(path):
+    spec = importlib.util.spec_from_file_location(os.path.basename(path)[:-3], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_roofs(module, n=3000, extent_m=2000, seed=0):
+    # Overlapping 6-20m boxes spread over several blocks near the city centre
+    rnd = random.Random(seed)
+    deg_lat = module.DEG_PER_METER
+    deg_lon = module.DEG_PER_METER / np.cos(np.radians(12.96))
+    roofs = []
+    for _ in range(n):
+        x = 77.57 + rnd.random() * extent_m * deg_lon
+        y = 12.95 + rnd.random() * extent_m * deg_lat
+        w, h = rnd.uniform(6, 20), rnd.uniform(6, 20)
+        roofs.append(box(x, y, x + w * deg_lon, y + h * deg_lat))
+    return roofs
+
+
+@pytest.fixture(params=SCRIPTS, ids=["five_ward", "hosakerahalli"])
+def script(request):
+    return load_script(request.param)
+
+
+def test_hierarchical_union_matches_unary_union(script):
+    roofs = make_roofs(script)
+    blocks = script.bucket_by_block(roofs)
+    assert len(blocks) > 1
+
+    expected = unary_union(roofs)
+    result = script.hierarchical_union(blocks)
+    assert result.is_valid
+    assert result.symmetric_difference(expected).area == pytest.approx(0, abs=1e-14)
+
+
+def test_hierarchical_union_with_pool_matches_unary_union(script, monkeypatch):
+    monkeypatch.setattr(script, "COVERAGE_PARALLEL_MIN_BLOCKS", 0)
+    monkeypatch.setattr(script, "COVERAGE_PARALLEL_MIN_ROOFS", 0)
+    roofs = make_roofs(script, n=500)
+
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        result = script.hierarchical_union(script.bucket_by_block(roofs), pool)
+    assert result.symmetric_difference(unary_union(roofs)).area == pytest.approx(0, abs=1e-14)
+
+
+def test_hierarchical_union_geom_type_matches_unary_union(script):
+    # A single strip crossing several block edges, a scattered set and a dense set
+    deg_lon = script.DEG_PER_METER / np.cos(np.radians(12.96))
+    strip = [box(77.5745 + i * 10 * deg_lon, 12.951, 77.5745 + (i * 10 + 15) * deg_lon,
+                 12.951 + 10 * script.DEG_PER_METER) for i in range(200)]
+    for roofs in (strip, make_roofs(script), make_roofs(script, n=3000, extent_m=600)):
+        blocks = script.bucket_by_block(roofs)
+        assert len(blocks) > 1
+        expected = unary_union(roofs)
+        result = script.hierarchical_union(blocks)
+        assert result.geom_type == expected.geom_type
+        assert result.symmetric_difference(expected).area == pytest.approx(0, abs=1e-14)
+
+
+def test_coverage_stats_for_known_roofs(script):
+    deg_lat = script.DEG_PER_METER
+    deg_lon = script.DEG_PER_METER / np.cos(np.radians(12.95))
+    roof = box(77.57, 12.95, 77.57 + 20 * deg_lon, 12.95 + 10 * deg_lat)
+    stats = script.coverage_stats(roof)
+    assert stats["coverage_area_m2"] == pytest.approx(200, rel=1e-3)
+    assert stats["coverage_density"] == pytest.approx(1)
+
+    # Two 200 m^2 roofs at opposite corners of a 40 x 40 m square
+    far = box(77.57 + 20 * deg_lon, 12.95 + 30 * deg_lat, 77.57 + 40 * deg_lon, 12.95 + 40 * deg_lat)
+    stats = script.coverage_stats(unary_union([roof, far]))
+    assert stats["coverage_area_m2"] == pytest.approx(400, rel=1e-3)
+    assert stats["coverage_density"] == pytest.approx(400 / 1000, rel=1e-3)